@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
-import glob
+import argparse
+import concurrent.futures
+import dataclasses
+import functools
+import gzip
+import hashlib
 import os
 import re
+import shlex
+import shutil
 import sys
 import subprocess
+import tempfile
 import logging
 from pathlib import Path
-from typing import Optional, Tuple, Dict
+from typing import Any, Callable, NamedTuple, Optional, Tuple, Dict, Iterable, List
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -18,126 +26,710 @@ PYTORCH_REPOS = {
     "text": "https://github.com/pytorch/text.git"
 }
 
+# Componenti PyTorch disabilitati di default (riabilitabili con --with-<nome>)
+OPTIONAL_COMPONENTS = {
+    "caffe2": ["BUILD_CAFFE2", "BUILD_CAFFE2_OPS"],
+    "distributed": ["USE_DISTRIBUTED", "USE_NCCL", "USE_TENSORPIPE"],
+    "xnnpack": ["USE_XNNPACK"],
+    "fbgemm": ["USE_FBGEMM"],
+    "qnnpack": ["USE_QNNPACK"],
+    "nnpack": ["USE_NNPACK"],
+    "mkldnn": ["USE_MKLDNN"],
+    "kineto": ["USE_KINETO"]
+}
+
+# Dipendenze di build comuni a tutti i pacchetti
+BUILD_REQUIREMENTS = [
+    "astunparse", "numpy", "pyyaml", "typing_extensions",
+    "future", "six", "requests", "setuptools", "wheel",
+    "cmake", "ninja"
+]
+
+# Numero di fetch paralleli per clone e submodules (I/O di rete, non CPU)
+GIT_JOBS = max(4, os.cpu_count() or 1)
+
+ROCM_DEFAULT_PATH = "/opt/rocm"
+CACHE_DIR = Path.home() / ".cache" / "torch-rocm-compiler"
+# La cache dei wheel può puntare a una directory condivisa (es. NFS) per riusare le build del team
+WHEEL_CACHE_DIR = Path(os.environ.get("TORCH_ROCM_WHEEL_CACHE", CACHE_DIR / "wheels"))
+
+
+@dataclasses.dataclass(frozen=True)
+class BuildConfig:
+    """Opzioni di build condivise da tutti i pacchetti."""
+    python_cmd: str = "python3.11"
+    gpu_arch: str = "gfx1102"
+    components: Tuple[str, ...] = ()
+    parallel_builds: int = 1
+    warmup: bool = False
+    debug_info: bool = False
+    wheel_cache: bool = True
+    fast_math: bool = False
+    split_build: bool = False
+    strip: bool = False
+
+
+class RocmVersion(NamedTuple):
+    """Versione di ROCm confrontabile numericamente (rocm-6.10.0 > rocm-6.9.0)."""
+    major: int
+    minor: int
+    patch: int
+
+    @classmethod
+    def parse(cls, version: str) -> 'RocmVersion':
+        major, minor, patch = map(int, version.split('.')[:3])
+        return cls(major, minor, patch)
+
+    def __str__(self) -> str:
+        return f"{self.major}.{self.minor}.{self.patch}"
+
+
+# Operazioni eseguite dopo l'installazione per popolare le cache di MIOpen e dei kernel HIP
+WARMUP_SCRIPT = """
+import torch
+for dtype in (torch.float32, torch.float16):
+    x = torch.randn(16, 64, 56, 56, device='cuda', dtype=dtype)
+    conv = torch.nn.Conv2d(64, 64, 3, padding=1).to('cuda', dtype)
+    conv(x).sum().backward()
+    a = torch.randn(1024, 1024, device='cuda', dtype=dtype)
+    (a @ a).sum(dim=1)
+torch.cuda.synchronize()
+"""
+
+# Equivalente di -ffast-math senza -ffinite-math-only, che con hipcc rompe la gestione di NaN/Inf
+FAST_MATH_FLAGS = [
+    '-DHIP_FAST_MATH',
+    '-ffp-contract=fast',
+    '-fno-math-errno',
+    '-fno-trapping-math',
+    '-fassociative-math',
+    '-freciprocal-math',
+    '-fno-signed-zeros'
+]
+
+LINKER_FLAG_VARS = ('LDFLAGS', 'CMAKE_EXE_LINKER_FLAGS', 'CMAKE_SHARED_LINKER_FLAGS', 'CMAKE_MODULE_LINKER_FLAGS')
+
+# Variabili d'ambiente che influenzano il wheel prodotto e quindi la chiave della cache
+_CACHE_KEY_ENV_PREFIXES = ('USE_', 'BUILD_', 'HIP', 'CMAKE_', 'PYTORCH_', 'REL_WITH_DEB_INFO')
+_CACHE_KEY_ENV_VARS = ('CC', 'CXX', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS')
+_CACHE_KEY_ENV_IGNORED = ('CMAKE_JOB_POOLS', 'CMAKE_JOB_POOL_COMPILE', 'CMAKE_JOB_POOL_LINK',
+                          'CMAKE_C_COMPILER_LAUNCHER', 'CMAKE_CXX_COMPILER_LAUNCHER', 'CMAKE_HIP_COMPILER_LAUNCHER',
+                          'CMAKE_PREFIX_PATH', 'HIPCC_VERBOSE')
+# Variabili della chiave che non richiedono di ricreare build/: le fasi della split build la condividono,
+# e la versione contiene il commit
+_BUILD_DIR_KEY_ENV_IGNORED = ('BUILD_LIBTORCH_WHL', 'BUILD_PYTHON_ONLY', 'PYTORCH_BUILD_VERSION',
+                              'PYTORCH_BUILD_NUMBER')
+
+# Sorgenti che determinano un wheel, come gruppi di pathspec git: di default tutto il repository
+_CACHE_KEY_SOURCES = ((".",),)
+# Per il wheel libtorch il codice Python e i test non contano, così la cache regge a modifiche ai binding
+_LIBTORCH_CACHE_KEY_SOURCES = (
+    (".", ":(glob,exclude)torch/**/*.py", ":(glob,exclude)torch/**/*.pyi", ":(exclude)test", ":(exclude)docs"),
+    # hipify è Python ma viene eseguito durante la build di libtorch
+    ("torch/utils/hipify",)
+)
+
+# Output verboso di hipcc mostrato solo a livello DEBUG (resta comunque nel log su file). I warning del
+# compilatore restano visibili: le righe di contesto che li seguono non sono riconoscibili singolarmente
+# (un'unica alternanza: viene valutata su ogni riga dell'output di build)
+_NOISY_LINE_RE = re.compile(
+    r'^\s*(?:hipcc-cmd|hipcc-args):'
+    r'|^\s*(?:HIP_PATH|HIP_PLATFORM|HIP_COMPILER|HIP_RUNTIME|HIP_CLANG_PATH|ROCM_PATH)='
+)
+
+_ROCM_SMI_RE = re.compile(r'ROCm-(\d+\.\d+\.\d+)')
+_VERSION_RE = re.compile(r'(\d+\.\d+\.\d+)')
+_ROCM_DIR_RE = re.compile(r'rocm-(\d+\.\d+\.\d+)$')
+
+
+def read_rocm_version_file(rocm_path: str) -> Optional[str]:
+    """Legge la versione di ROCm dai file di versione installati, senza lanciare processi."""
+    for version_file in (".info/version", ".info/version-dev", "share/doc/rocm-core/VERSION"):
+        try:
+            version_match = _VERSION_RE.search(Path(rocm_path, version_file).read_text())
+        except OSError:
+            continue
+        if version_match:
+            return version_match.group(1)
+    return None
+
 
+@functools.lru_cache(maxsize=1)
 def get_rocm_info() -> Tuple[str, str]:
-    """Rileva l'installazione di ROCm e la sua versione."""
-    default_path = "/opt/rocm"
-    if not os.path.exists(default_path):
+    """Rileva l'installazione di ROCm e la sua versione.
+
+    Memoizzata solo nel processo: la versione si legge da file senza lanciare processi, e una cache su
+    disco dovrebbe essere invalidata anche per i fallback (symlink, /opt, rocm-smi).
+    """
+    default_path = ROCM_DEFAULT_PATH
+
+    # Se il version file è leggibile il path esiste: il controllo serve solo per i fallback
+    version = read_rocm_version_file(default_path)
+    if version:
+        return default_path, version
+
+    if not os.path.isdir(default_path):
         raise RuntimeError(f"ROCm path {default_path} non trovato")
 
+    # /opt/rocm è di solito un symlink a /opt/rocm-X.Y.Z
+    version_match = _ROCM_DIR_RE.search(os.path.realpath(default_path))
+    if version_match:
+        return default_path, version_match.group(1)
+
+    with os.scandir("/opt") as entries:
+        versions = [RocmVersion.parse(version_match.group(1)) for entry in entries
+                    if (version_match := _ROCM_DIR_RE.match(entry.name))]
+    if versions:
+        return default_path, str(max(versions))
+
+    # rocm-smi è uno script Python lento ad avviarsi: solo come ultima risorsa
     try:
         result = subprocess.run(['rocm-smi', '--showversion'],
                                 capture_output=True, text=True, check=True)
-        version_match = re.search(r'ROCm-(\d+\.\d+\.\d+)', result.stdout)
+        version_match = _ROCM_SMI_RE.search(result.stdout)
         if version_match:
             return default_path, version_match.group(1)
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, FileNotFoundError):
         pass
 
-    rocm_dirs = glob.glob("/opt/rocm-*")
-    if rocm_dirs:
-        latest_dir = sorted(rocm_dirs)[-1]
-        version_match = re.search(r'rocm-(\d+\.\d+\.\d+)', latest_dir)
-        if version_match:
-            return default_path, version_match.group(1)
-
     raise RuntimeError("Non è stato possibile determinare la versione di ROCm")
 
 
-def setup_build_env(rocm_path: str, gpu_arch: str) -> Dict[str, str]:
-    """Configura l'ambiente di build per ROCm."""
-    env = os.environ.copy()
+@functools.lru_cache(maxsize=None)
+def find_tool(name: str, path: Optional[str] = None) -> Optional[str]:
+    """shutil.which con memoizzazione: i probe si ripetono per ogni pacchetto compilato.
+
+    Non persistita su disco come get_rocm_info: una ricerca nel PATH costa meno della lettura di una cache.
+    """
+    return shutil.which(name, path=path)
+
+
+def setup_compiler_cache(env: Dict[str, str], rocm_version: str, gpu_arch: str) -> Optional[str]:
+    """Configura ccache (o sccache) come launcher dei compilatori, con una cache per arch e versione ROCm.
+
+    Restituisce il launcher usato, None se nessuno è disponibile.
+    """
+    cache_path = os.path.expanduser(f"~/.cache/pytorch-rocm-ccache/{gpu_arch}-{rocm_version}")
+
+    if find_tool('ccache'):
+        launcher = 'ccache'
+        env.update({
+            'CCACHE_DIR': cache_path,
+            'CCACHE_MAXSIZE': '50G',
+            'CCACHE_SLOPPINESS': 'pch_defines,time_macros,include_file_mtime',
+            'CCACHE_COMPILERCHECK': 'content'
+        })
+    elif find_tool('sccache'):
+        launcher = 'sccache'
+        env.update({
+            'SCCACHE_DIR': cache_path,
+            'SCCACHE_CACHE_SIZE': '50G'
+        })
+    else:
+        logger.warning("ccache/sccache non trovati, build senza cache dei compilatori")
+        return None
 
     env.update({
-        'ROCM_HOME': rocm_path,
-        'ROCM_PATH': rocm_path,
-        'HIP_PATH': f"{rocm_path}/hip",
-        'HIP_PLATFORM': 'amd',
-        'HIP_COMPILER': 'clang',
-        'HIP_RUNTIME': 'rocclr',
-        'HIP_CLANG_PATH': f"{rocm_path}/llvm/bin",
-        'HIPCC_PATH': f"{rocm_path}/bin/hipcc",
-        'PATH': f"{rocm_path}/bin:{rocm_path}/llvm/bin:{env.get('PATH', '')}",
-        'LD_LIBRARY_PATH': f"{rocm_path}/lib:{env.get('LD_LIBRARY_PATH', '')}"
+        'CMAKE_C_COMPILER_LAUNCHER': launcher,
+        'CMAKE_CXX_COMPILER_LAUNCHER': launcher,
+        'CMAKE_HIP_COMPILER_LAUNCHER': launcher
+    })
+    return launcher
+
+
+def setup_linker(env: Dict[str, str], rocm_path: str) -> bool:
+    """Usa lld di ROCm al posto di GNU ld, molto più veloce sul link di libtorch."""
+    if not os.path.exists(f"{rocm_path}/llvm/bin/ld.lld"):
+        logger.warning(f"ld.lld non trovato in {rocm_path}/llvm/bin, uso il linker di sistema")
+        return False
+
+    append_flags(env, LINKER_FLAG_VARS, '-fuse-ld=lld')
+    return True
+
+
+def append_flags(env: Dict[str, str], variables: Iterable[str], flags: str) -> None:
+    """Aggiunge flag in coda alle variabili indicate, preservando i valori già presenti."""
+    for var in variables:
+        env[var] = f"{env.get(var, '')} {flags}".strip()
+
+
+def setup_debug_info(env: Dict[str, str], use_lld: bool) -> None:
+    """Build RelWithDebInfo con debug info separate (.dwo), così il linker non deve copiare il DWARF."""
+    env['REL_WITH_DEB_INFO'] = '1'
+    append_flags(env, ('CFLAGS', 'CXXFLAGS'), '-gsplit-dwarf')
+    # GNU ld non supporta --gdb-index
+    if use_lld:
+        append_flags(env, LINKER_FLAG_VARS, '-Wl,--gdb-index')
+
+
+def setup_section_gc(env: Dict[str, str]) -> None:
+    """Una sezione per funzione/dato, così il linker può scartare il codice non raggiunto dalle librerie."""
+    append_flags(env, ('CFLAGS', 'CXXFLAGS'), '-ffunction-sections -fdata-sections')
+    append_flags(env, LINKER_FLAG_VARS, '-Wl,--gc-sections -Wl,-O2 -Wl,--hash-style=gnu')
+
+
+def is_elf(path: Path) -> bool:
+    """Indica se path è un file ELF, controllando il magic number."""
+    if not path.is_file():
+        return False
+    with open(path, 'rb') as f:
+        return f.read(4) == b'\x7fELF'
+
+
+def strip_wheel(wheel: Path, python_cmd: str, env: Dict[str, str]) -> None:
+    """Rimuove i simboli non necessari dalle librerie condivise del wheel e lo ricrea con lo stesso nome."""
+    strip_cmd = find_tool('llvm-strip', env['PATH']) or find_tool('strip', env['PATH'])
+    if strip_cmd is None:
+        logger.warning("strip non trovato, wheel lasciato invariato")
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        unpack_dir, pack_dir = Path(tmp, "unpack"), Path(tmp, "pack")
+        pack_dir.mkdir()
+        subprocess.run([python_cmd, "-m", "wheel", "unpack", "-d", str(unpack_dir), str(wheel)], check=True)
+        unpacked = next(unpack_dir.iterdir())
+        # '*.so*' trova anche file come foo.sources: strip riceve solo gli ELF
+        libraries = [str(library) for library in unpacked.rglob('*.so*') if is_elf(library)]
+        if libraries:
+            subprocess.run([strip_cmd, '--strip-unneeded', *libraries], check=True)
+        # wheel pack rigenera RECORD con gli hash dei file modificati. Il wheel originale viene sostituito solo
+        # a pack riuscito, così un errore non fa perdere il risultato della build
+        subprocess.run([python_cmd, "-m", "wheel", "pack", "-d", str(pack_dir), str(unpacked)], check=True)
+        os.replace(next(pack_dir.glob('*.whl')), wheel)
+    logger.info(f"Simboli rimossi da {len(libraries)} librerie in {wheel.name}")
+
+
+def total_memory_gb() -> int:
+    """Restituisce la RAM fisica totale in GB."""
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1024 ** 3
+
+
+def setup_job_limits(env: Dict[str, str], parallel_builds: int = 1) -> None:
+    """Limita i job di ninja in base a core e RAM, con un pool separato per i link.
+
+    Con più build in parallelo ognuna riceve una quota uguale di core e di RAM.
+    """
+    cpu_count = max(1, (os.cpu_count() or 1) // parallel_builds)
+    memory_gb = total_memory_gb() // parallel_builds
+    # ~2 GB per job di compilazione, ~10 GB per job di link
+    jobs = min(cpu_count, max(1, memory_gb // 2))
+    link_jobs = min(jobs, max(1, memory_gb // 10))
+
+    env.update({
+        'MAX_JOBS': str(jobs),
+        'CMAKE_JOB_POOLS': f"compile={jobs};link={link_jobs}",
+        'CMAKE_JOB_POOL_COMPILE': 'compile',
+        'CMAKE_JOB_POOL_LINK': 'link',
+        'NINJA_STATUS': '[%f/%t %es] '
     })
 
+
+def dedup_flags(flags: List[str]) -> List[str]:
+    """Rimuove i flag duplicati mantenendo l'ordine.
+
+    '-mllvm <opzione>' è trattato come un unico flag. Solleva ValueError se una macro -D
+    o --rocm-path compaiono con valori diversi.
+    """
+    grouped = []
+    args = iter(flags)
+    for flag in args:
+        grouped.append((flag, next(args)) if flag == '-mllvm' else (flag,))
+
+    values = {}
+    for group in grouped:
+        flag = group[0]
+        if flag.startswith('-D') or flag.startswith('--rocm-path='):
+            name, _, value = flag.partition('=')
+            if values.setdefault(name, value) != value:
+                raise ValueError(f"Flag in conflitto: {name}={values[name]} e {flag}")
+
+    return [flag for group in dict.fromkeys(grouped) for flag in group]
+
+
+@functools.lru_cache(maxsize=4)
+def rocm_env_overrides(rocm_path: str, gpu_arch: str, fast_math: bool = False) -> Dict[str, str]:
+    """Calcola le variabili ROCm che dipendono solo da path, arch e flag matematici.
+
+    Il dizionario restituito è condiviso tra le chiamate: va letto, non modificato.
+    """
     hip_flags = [
         f'--rocm-path={rocm_path}',
         f'--offload-arch={gpu_arch}',
         '-D__HIP_PLATFORM_AMD__=1',
         '-D_GLIBCXX_USE_CXX11_ABI=0',
         '-Wno-missing-prototypes',
-        '-Wno-error=missing-prototypes'
+        '-Wno-error=missing-prototypes',
+        # Gli stessi di hipcc: senza, clang usato direttamente da CMake genera chiamate a funzione lente nei kernel
+        '-mllvm', '-amdgpu-early-inline-all=true',
+        '-mllvm', '-amdgpu-function-calls=false'
     ]
+    if fast_math:
+        hip_flags += FAST_MATH_FLAGS
+    hip_flags = shlex.join(dedup_flags(hip_flags))
+    logger.info(f"Flag HIP: {hip_flags}")
 
-    env.update({
-        'HIPCC_COMPILE_FLAGS_APPEND': ' '.join(hip_flags),
-        'HIP_HIPCC_FLAGS': ' '.join(hip_flags),
-        'CMAKE_HIP_FLAGS': ' '.join(hip_flags),
-        'CMAKE_PREFIX_PATH': f"{rocm_path}/lib/cmake/hip:{env.get('CMAKE_PREFIX_PATH', '')}",
+    return {
+        'ROCM_HOME': rocm_path,
+        'ROCM_PATH': rocm_path,
+        'HIP_PATH': f"{rocm_path}/hip",
+        'HIP_PLATFORM': 'amd',
+        'HIP_COMPILER': 'clang',
+        'HIP_RUNTIME': 'rocclr',
+        'HIP_CLANG_PATH': f"{rocm_path}/llvm/bin",
+        'HIPCC_PATH': f"{rocm_path}/bin/hipcc",
+        # hipcc aggiunge HIPCC_COMPILE_FLAGS_APPEND a ogni invocazione. CMAKE_HIP_FLAGS è inoltrato da setup.py
+        # come -D quando esegue cmake; HIPCXX/HIPFLAGS coprono i progetti che non inoltrano CMAKE_*. cmake gira
+        # solo su una build directory nuova (o con --cmake): prepare_build_dir la ricrea se i flag cambiano
+        'HIPCC_COMPILE_FLAGS_APPEND': hip_flags,
+        'CMAKE_HIP_FLAGS': hip_flags,
+        'HIPCXX': f"{rocm_path}/llvm/bin/clang++",
+        'HIPFLAGS': hip_flags,
         'USE_ROCM': '1',
         'PYTORCH_ROCM_ARCH': gpu_arch,
         'USE_NINJA': '1',
+        'CMAKE_GENERATOR': 'Ninja',
         'BUILD_TEST': '0'
+    }
+
+
+def setup_build_env(rocm_path: str, rocm_version: str, config: BuildConfig) -> Dict[str, str]:
+    """Configura l'ambiente di build per ROCm."""
+    env = os.environ.copy()
+
+    env.update(rocm_env_overrides(rocm_path, config.gpu_arch, config.fast_math))
+    env.update({
+        'PATH': f"{rocm_path}/bin:{rocm_path}/llvm/bin:{env.get('PATH', '')}",
+        'LD_LIBRARY_PATH': f"{rocm_path}/lib:{env.get('LD_LIBRARY_PATH', '')}",
+        'CMAKE_PREFIX_PATH': f"{rocm_path}/lib/cmake/hip:{env.get('CMAKE_PREFIX_PATH', '')}"
     })
 
-    return env
+    if find_tool('ninja', env['PATH']) is None:
+        raise RuntimeError("ninja non trovato nel PATH: installalo con 'pip install ninja'")
 
+    enabled = set(config.components)
+    for component, variables in OPTIONAL_COMPONENTS.items():
+        value = '1' if component in enabled else '0'
+        env.update({var: value for var in variables})
 
-def clone_repo(repo_name: str, target_path: Path) -> None:
-    """Clona una repository PyTorch se non esiste."""
-    if not target_path.exists():
-        logger.info(f"Clonazione {repo_name} in {target_path}")
-        subprocess.run(["git", "clone", "--recurse", PYTORCH_REPOS[repo_name], str(target_path)], check=True)
+    setup_job_limits(env, config.parallel_builds)
+    use_lld = setup_linker(env, rocm_path)
+    setup_section_gc(env)
+    if config.debug_info:
+        setup_debug_info(env, use_lld)
+    setup_compiler_cache(env, rocm_version, config.gpu_arch)
 
-    setup_repo(target_path)
+    return env
 
 
-def setup_repo(repo_path: Path) -> None:
-    """Configura una repository per la build."""
-    logger.info(f"Configurazione {repo_path}")
+def clone_repo(repo_name: str, target_path: Path, full_history: bool = False) -> None:
+    """Clona una repository PyTorch se non esiste.
 
-    subprocess.run(["git", "submodule", "sync", "--recursive"], cwd=repo_path, check=True)
-    subprocess.run(["git", "submodule", "update", "--init", "--recursive"], cwd=repo_path, check=True)
+    Di default il clone è shallow e senza blob storici: per la build serve solo il working tree.
+    """
+    if not target_path.exists():
+        logger.info(f"Clonazione {repo_name} in {target_path}")
+        clone_cmd = ["git", "clone", "--recurse-submodules", "--jobs", str(GIT_JOBS)]
+        if not full_history:
+            clone_cmd += ["--depth=1", "--filter=blob:none", "--shallow-submodules"]
+        subprocess.run(clone_cmd + [PYTORCH_REPOS[repo_name], str(target_path)], check=True)
+
+
+def install_build_requirements(python_cmd: str, repo_paths: Iterable[Path]) -> None:
+    """Installa in un'unica chiamata pip le dipendenze di build di tutti i pacchetti nell'interprete della build.
+
+    L'installazione viene saltata se requirements e interprete non sono cambiati dall'ultima volta.
+    """
+    # Path risolto: lo stesso nome (es. python3.11) può indicare interpreti diversi a seconda del PATH
+    digest = hashlib.sha256((find_tool(python_cmd) or python_cmd).encode())
+    digest.update(" ".join(BUILD_REQUIREMENTS).encode())
+
+    requirement_files = []
+    for path in repo_paths:
+        try:
+            digest.update((path / "requirements.txt").read_bytes())
+        except FileNotFoundError:
+            continue
+        requirement_files.append(path / "requirements.txt")
+    key = digest.hexdigest()
+
+    sentinel = CACHE_DIR / "deps-installed.v1"
+    try:
+        if sentinel.read_text() == key:
+            logger.info("Dipendenze di build già installate")
+            return
+    except OSError:
+        pass
 
-    requirements = [
-        "astunparse", "numpy", "pyyaml", "typing_extensions",
-        "future", "six", "requests", "setuptools", "wheel",
-        "cmake", "ninja"
-    ]
+    pip_cmd = [python_cmd, "-m", "pip", "install"]
+    for requirement_file in requirement_files:
+        pip_cmd += ["-r", str(requirement_file)]
 
-    if (repo_path / "requirements.txt").exists():
-        subprocess.run([sys.executable, "-m", "pip", "install", "-r", "requirements.txt"],
-                       cwd=repo_path, check=True)
+    env = os.environ.copy()
+    env.setdefault('PIP_CACHE_DIR', str(CACHE_DIR / "pip"))
+    subprocess.run(pip_cmd + BUILD_REQUIREMENTS, env=env, check=True)
 
-    subprocess.run([sys.executable, "-m", "pip", "install"] + requirements, check=True)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    sentinel.write_text(key)
 
 
 def init_repo(repo_path: Path) -> None:
     """Inizializza il repository con submodules."""
     logger.info("Inizializzazione submodules...")
     subprocess.run(["git", "submodule", "sync", "--recursive"], cwd=repo_path, check=True)
-    subprocess.run(["git", "submodule", "update", "--init", "--recursive"], cwd=repo_path, check=True)
+    subprocess.run(["git", "-c", f"submodule.fetchJobs={GIT_JOBS}", "submodule", "update", "--init", "--recursive",
+                    "--jobs", str(GIT_JOBS)], cwd=repo_path, check=True)
+
+
+def run_and_log(cmd: List[str], env: Dict[str, str], cwd: Path, log_path: Path) -> None:
+    """Esegue un comando mostrando l'output in tempo reale e salvandolo in un log compresso."""
+    log_path.parent.mkdir(parents=True, exist_ok=True)
+    logger.info(f"Log della build in {log_path}")
+
+    # errors='replace': un byte non UTF-8 nell'output (es. sorgenti Latin-1 citati nei warning) non deve
+    # interrompere la build
+    with gzip.open(log_path, 'wt') as log_file:
+        with subprocess.Popen(cmd, env=env, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              bufsize=1, text=True, errors='replace') as proc:
+            for line in proc.stdout:
+                log_file.write(line)
+                level = logging.DEBUG if _NOISY_LINE_RE.search(line) else logging.INFO
+                logger.log(level, line.rstrip())
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
 
+def find_wheel_in(directory: Path) -> Optional[Path]:
+    """Restituisce il wheel più recente nella directory indicata."""
+    wheels = list(directory.glob('*.whl'))
+    if not wheels:
+        return None
+    return max(wheels, key=lambda wheel: wheel.stat().st_mtime)
 
-def build_package(source_path: Path, python_cmd: str, gpu_arch: str) -> bool:
-    """Compila un pacchetto PyTorch."""
+
+def find_wheel(source_path: Path) -> Optional[Path]:
+    """Restituisce il wheel più recente nella directory dist del pacchetto."""
+    return find_wheel_in(source_path / 'dist')
+
+
+def run_probes(probes: Dict[str, Callable[[], Any]]) -> Dict[str, Any]:
+    """Esegue in parallelo controlli indipendenti (subprocess, I/O) e ne raccoglie i risultati.
+
+    Un probe fallito non interrompe gli altri: gli errori vengono riportati tutti in un unico RuntimeError.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(probes)) as executor:
+        futures = {name: executor.submit(probe) for name, probe in probes.items()}
+
+    results, errors = {}, []
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            errors.append(f"{name}: {e}")
+
+    if errors:
+        raise RuntimeError("Controlli falliti: " + "; ".join(errors))
+    return results
+
+
+def cache_key_env(env: Dict[str, str]) -> List[str]:
+    """Restituisce, in ordine, le variabili d'ambiente che influenzano il wheel prodotto."""
+    return [var for var in sorted(env)
+            if var not in _CACHE_KEY_ENV_IGNORED
+            and (var.startswith(_CACHE_KEY_ENV_PREFIXES) or var in _CACHE_KEY_ENV_VARS)]
+
+
+def prepare_build_dir(source_path: Path, env: Dict[str, str], config: BuildConfig) -> None:
+    """Ricrea build/ se era stata configurata con flag diversi.
+
+    setup.py non riesegue cmake su una build directory esistente e ninja non vede le variabili lette da
+    hipcc: senza questo controllo un cambio di flag produrrebbe un wheel con i flag vecchi, salvato in cache
+    sotto la chiave nuova.
+    """
+    digest = hashlib.sha256(config.python_cmd.encode())
+    for var in cache_key_env(env):
+        if var not in _BUILD_DIR_KEY_ENV_IGNORED:
+            digest.update(f"{var}={env[var]}\n".encode())
+    key = digest.hexdigest()
+
+    build_dir = source_path / 'build'
+    key_file = build_dir / '.torch-rocm-compiler-key'
     try:
-        init_repo(source_path)
-        rocm_path, rocm_version = get_rocm_info()
-        logger.info(f"ROCm {rocm_version} trovato in {rocm_path}")
+        if key_file.read_text() == key:
+            return
+    except OSError:
+        pass
 
-        env = setup_build_env(rocm_path, gpu_arch)
+    if build_dir.exists():
+        logger.info(f"Flag di build cambiati, ricreo {build_dir}")
+        shutil.rmtree(build_dir)
+    build_dir.mkdir()
+    key_file.write_text(key)
+
+
+def wheel_cache_dir(source_path: Path, env: Dict[str, str], rocm_version: str, config: BuildConfig,
+                    sources: Tuple[Tuple[str, ...], ...] = _CACHE_KEY_SOURCES) -> Optional[Path]:
+    """Calcola la directory della cache wheel per gli input della build.
+
+    La chiave combina i file tracciati in sources (hash git) e i submodules, interprete, flag di build e,
+    per i pacchetti che dipendono da pytorch, la versione di torch installata (vi compilano contro).
+    Restituisce None se sources (submodules compresi) ha modifiche non committate, che la chiave non coprirebbe.
+    """
+    def git_output(*args: str) -> str:
+        return subprocess.run(["git", *args], cwd=source_path, capture_output=True, text=True, check=True).stdout
+
+    def git_sources(*args: str) -> str:
+        return "".join(git_output(*args, "--", *pathspec) for pathspec in sources)
+
+    def python_tag() -> str:
+        return subprocess.run([config.python_cmd, "-c", "import sys; print(sys.implementation.cache_tag)"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+
+    def torch_version() -> str:
+        if source_path.name == "pytorch":
+            return ""
+        return subprocess.run([config.python_cmd, "-c",
+                               "import torch; print(torch.__version__, torch.version.git_version)"],
+                              capture_output=True, text=True, check=True).stdout.strip()
+
+    inputs = run_probes({
+        "files": lambda: git_sources("ls-files", "--stage"),
+        "submodules": lambda: git_output("submodule", "status", "--recursive"),
+        "status": lambda: git_sources("status", "--porcelain", "--untracked-files=all"),
+        "python": python_tag,
+        "torch": torch_version
+    })
+
+    if inputs["status"]:
+        logger.warning(f"{source_path.name} ha modifiche non committate, cache dei wheel non usata")
+        return None
+
+    digest = hashlib.sha256()
+    for name in ("files", "submodules", "python", "torch"):
+        digest.update(inputs[name].encode())
+    digest.update(f"strip={config.strip}".encode())
+    for var in cache_key_env(env):
+        digest.update(f"{var}={env[var]}\n".encode())
+
+    return WHEEL_CACHE_DIR / rocm_version / config.gpu_arch / source_path.name / digest.hexdigest()
+
+
+def pytorch_build_version(source_path: Path, rocm_version: str) -> Optional[str]:
+    """Versione deterministica del wheel di pytorch: base di version.txt + ROCm + commit.
+
+    Restituisce None se version.txt manca. Solo pytorch legge PYTORCH_BUILD_VERSION: gli altri pacchetti
+    hanno un proprio version.txt ma usano variabili diverse.
+    """
+    try:
+        base_version = (source_path / "version.txt").read_text().strip()
+    except OSError:
+        return None
+    short_sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=source_path,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    return f"{base_version}+rocm{rocm_version}.git{short_sha}"
+
+
+def copy_wheel(src: Path, dst: Path) -> None:
+    """Copia un wheel tra dist e la cache.
+
+    Mai hard link: setup.py e wheel pack riscrivono dist sul posto (il nome del wheel di pytorch è
+    deterministico) e modificherebbero anche il wheel in cache.
+    """
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    dst.unlink(missing_ok=True)
+    shutil.copy(src, dst)
+
+
+def build_wheel(source_path: Path, env: Dict[str, str], rocm_version: str, config: BuildConfig,
+                stage: str = "", exec_build: bool = False, reconfigure: bool = False,
+                sources: Tuple[Tuple[str, ...], ...] = _CACHE_KEY_SOURCES) -> Optional[Path]:
+    """Esegue setup.py bdist_wheel, riusando il wheel in cache se gli input non sono cambiati.
+
+    Con reconfigure setup.py di pytorch riesegue cmake (--cmake) anche se la build directory è già configurata.
+
+    Con exec_build il processo corrente viene sostituito da setup.py (niente log su file, statistiche
+    della cache o salvataggio del wheel in cache): da usare solo come ultima operazione dello script.
+    """
+    name = f"{source_path.name}{stage}"
+    # Le build parallele condividono la stessa cache: azzerarne le statistiche falserebbe quelle delle altre
+    launcher = env.get('CMAKE_CXX_COMPILER_LAUNCHER') if config.parallel_builds == 1 else None
+
+    cache_dir = wheel_cache_dir(source_path, env, rocm_version, config, sources) if config.wheel_cache else None
+    cached_wheel = find_wheel_in(cache_dir) if cache_dir else None
+    if cached_wheel:
+        copy_wheel(cached_wheel, source_path / 'dist' / cached_wheel.name)
+        logger.info(f"Wheel trovato in cache, build di {name} saltata: {cached_wheel}")
+        return cached_wheel
+
+    build_cmd = [config.python_cmd, 'setup.py', 'bdist_wheel']
+    if reconfigure:
+        build_cmd.append('--cmake')
+    logger.info(f"Avvio build di {name} con {shlex.join(build_cmd)}")
+    prepare_build_dir(source_path, env, config)
+
+    if exec_build:
+        logger.info(f"Il wheel sarà generato in {source_path / 'dist'}")
+        logging.shutdown()
         os.chdir(source_path)
+        os.execvpe(build_cmd[0], build_cmd, env)
+
+    if launcher:
+        subprocess.run([launcher, '--zero-stats'], env=env, check=True)
 
-        build_cmd = [python_cmd, 'setup.py', 'bdist_wheel']
-        logger.info(f"Avvio build di {source_path.name} con {' '.join(build_cmd)}")
+    run_and_log(build_cmd, env, source_path, CACHE_DIR / "logs" / f"{name}.log.gz")
 
-        subprocess.run(build_cmd, env=env, check=True)
+    if launcher:
+        stats = subprocess.run([launcher, '--show-stats'], env=env, capture_output=True, text=True)
+        logger.info(f"Statistiche {launcher}:\n{stats.stdout}")
 
-        wheels = list(Path('dist').glob('*.whl'))
-        if wheels:
-            logger.info(f"Build completata: {wheels[-1]}")
+    wheel = find_wheel(source_path)
+    if wheel and config.strip:
+        strip_wheel(wheel, config.python_cmd, env)
+    if wheel and cache_dir:
+        copy_wheel(wheel, cache_dir / wheel.name)
+    return wheel
+
+
+def build_package(source_path: Path, config: BuildConfig, exec_build: bool = False) -> bool:
+    """Compila un pacchetto PyTorch.
+
+    Con config.split_build pytorch viene compilato in due wheel: libtorch (la parte C++/HIP, lenta)
+    e i binding Python. Le due fasi condividono build/, quindi ognuna riesegue cmake con le proprie opzioni.
+    Solo libtorch passa dalla cache dei wheel, con una chiave che ignora il codice Python di torch: modifiche
+    ai binding, anche non committate, riusano libtorch e ricompilano solo la seconda fase.
+    """
+    try:
+        probes = run_probes({
+            "submodules": lambda: init_repo(source_path),
+            "rocm": get_rocm_info
+        })
+        rocm_path, rocm_version = probes["rocm"]
+        logger.info(f"ROCm {rocm_version} trovato in {rocm_path}")
+
+        env = setup_build_env(rocm_path, rocm_version, config)
+
+        split_build = config.split_build and source_path.name == "pytorch"
+        if split_build:
+            # Senza PYTORCH_BUILD_VERSION, che contiene il commit: la chiave di libtorch deve restare valida
+            # finché non cambiano i suoi sorgenti
+            libtorch_wheel = build_wheel(source_path, dict(env, BUILD_LIBTORCH_WHL='1'), rocm_version, config,
+                                         stage="-libtorch", reconfigure=True, sources=_LIBTORCH_CACHE_KEY_SOURCES)
+            if not libtorch_wheel:
+                logger.error("Nessun wheel libtorch trovato dopo la build")
+                return False
+            subprocess.run([config.python_cmd, "-m", "pip", "install", "--force-reinstall", "--no-deps",
+                            str(libtorch_wheel)], check=True)
+            env['BUILD_PYTHON_ONLY'] = '1'
+            config = dataclasses.replace(config, wheel_cache=False)
+
+        build_version = pytorch_build_version(source_path, rocm_version) if source_path.name == "pytorch" else None
+        if build_version:
+            env.update({'PYTORCH_BUILD_VERSION': build_version, 'PYTORCH_BUILD_NUMBER': '1'})
+
+        wheel = build_wheel(source_path, env, rocm_version, config, exec_build=exec_build,
+                            reconfigure=split_build)
+        if wheel:
+            logger.info(f"Build completata: {wheel}")
             return True
 
         logger.error("Nessun wheel trovato dopo la build")
@@ -148,29 +740,130 @@ def build_package(source_path: Path, python_cmd: str, gpu_arch: str) -> bool:
         return False
 
 
-def main():
-    if len(sys.argv) < 2:
-        print("Uso: script.py <base_path> [python_cmd] [gpu_arch] [packages...]")
-        print("Packages disponibili:", ", ".join(PYTORCH_REPOS.keys()))
-        #sys.exit(1)
+def warmup_kernel_cache(python_cmd: str) -> bool:
+    """Esegue conv, gemm e riduzioni sulla GPU per popolare le cache di MIOpen e HIP.
+
+    Sposta al momento della build la compilazione dei kernel che altrimenti avverrebbe al primo utilizzo.
+    """
+    logger.info("Warmup delle cache MIOpen/HIP...")
+    try:
+        subprocess.run([python_cmd, "-c", WARMUP_SCRIPT], check=True)
+    except subprocess.CalledProcessError as e:
+        logger.warning(f"Warmup fallito: {e}")
+        return False
+
+    # I kernel compilati finiscono nella cache dei binari, non nel perf DB utente (~/.config/miopen)
+    logger.info(f"Cache dei kernel MIOpen popolata in {os.environ.get('MIOPEN_CUSTOM_CACHE_DIR', '~/.cache/miopen')}")
+    return True
+
+
+def build_dependent_packages(package_paths: List[Path], config: BuildConfig) -> List[str]:
+    """Compila in parallelo i pacchetti che dipendono solo da pytorch.
+
+    Core e RAM disponibili vengono divisi tra le build. Restituisce i nomi dei pacchetti falliti.
+    """
+    config = dataclasses.replace(config, parallel_builds=len(package_paths))
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(package_paths)) as executor:
+        futures = {
+            executor.submit(build_package, path, config): path.name
+            for path in package_paths
+        }
+        return [futures[future] for future in concurrent.futures.as_completed(futures) if not future.result()]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Compila PyTorch e i pacchetti correlati per ROCm")
+    parser.add_argument("base_path", nargs="?", default="pytorch/",
+                        help="Directory in cui clonare i sorgenti")
+    parser.add_argument("python_cmd", nargs="?", default=BuildConfig.python_cmd,
+                        help="Interprete Python usato per la build")
+    parser.add_argument("gpu_arch", nargs="?", default=BuildConfig.gpu_arch,
+                        help="Architettura GPU target")
+    parser.add_argument("packages", nargs="*", default=["pytorch"],
+                        help=f"Pacchetti da compilare ({', '.join(PYTORCH_REPOS.keys())})")
+    parser.add_argument("--full-history", action="store_true",
+                        help="Clona la storia completa invece di un clone shallow")
+    parser.add_argument("--debug-info", action="store_true",
+                        help="Build RelWithDebInfo con -gsplit-dwarf per link più rapidi in sviluppo")
+    parser.add_argument("--no-wheel-cache", dest="wheel_cache", action="store_false",
+                        help="Ricompila sempre, senza cercare o salvare wheel in cache")
+    parser.add_argument("--fast-math", action="store_true",
+                        help="Compila i kernel HIP con matematica non IEEE (FMA, riassociazione, niente errno)")
+    parser.add_argument("--split-build", action="store_true",
+                        help="Compila pytorch come wheel libtorch + wheel Python, con libtorch in cache separata")
+    parser.add_argument("--strip", action="store_true",
+                        help="Rimuove i simboli non necessari dalle librerie del wheel (strip --strip-unneeded)")
+    parser.add_argument("--exec", dest="exec_build", action="store_true",
+                        help="Sostituisce lo script con setup.py (un solo pacchetto, senza log su file "
+                             "né salvataggio del wheel in cache)")
+    parser.add_argument("--warmup", action="store_true",
+                        help="Dopo l'installazione di pytorch popola le cache dei kernel MIOpen/HIP")
+    for component in OPTIONAL_COMPONENTS:
+        parser.add_argument(f"--with-{component}", dest="components", action="append_const", const=component,
+                            default=[], help=f"Abilita il componente {component} (disabilitato di default)")
+    # Le opzioni possono stare anche tra un argomento posizionale e l'altro
+    return parser.parse_intermixed_args()
 
-    base_path = Path(sys.argv[1]).resolve() if len(sys.argv) > 1 else Path("pytorch/")
-    python_cmd = sys.argv[2] if len(sys.argv) > 2 else "python3.11"
-    gpu_arch = sys.argv[3] if len(sys.argv) > 3 else "gfx1102"
-    packages = sys.argv[4:] if len(sys.argv) > 4 else ["pytorch"]
+
+def main():
+    args = parse_args()
+
+    base_path = Path(args.base_path).resolve()
+    config = BuildConfig(
+        python_cmd=args.python_cmd,
+        gpu_arch=args.gpu_arch,
+        components=tuple(args.components),
+        warmup=args.warmup,
+        debug_info=args.debug_info,
+        wheel_cache=args.wheel_cache,
+        fast_math=args.fast_math,
+        split_build=args.split_build,
+        strip=args.strip
+    )
+    packages = args.packages
 
     invalid_packages = set(packages) - set(PYTORCH_REPOS.keys())
     if invalid_packages:
         logger.error(f"Pacchetti non validi: {invalid_packages}")
         sys.exit(1)
 
+    if args.exec_build and (len(packages) != 1 or config.warmup):
+        logger.error("--exec richiede un solo pacchetto e non è compatibile con --warmup")
+        sys.exit(1)
+
     base_path.mkdir(parents=True, exist_ok=True)
 
     for package in packages:
-        package_path = base_path / package
-        clone_repo(package, package_path)
-        if not build_package(package_path, python_cmd, gpu_arch):
-            logger.error(f"Build di {package} fallita")
+        clone_repo(package, base_path / package, args.full_history)
+    install_build_requirements(config.python_cmd, (base_path / package for package in packages))
+
+    if args.exec_build:
+        # Ritorna solo se il wheel era in cache o se la build non è partita
+        if not build_package(base_path / packages[0], config, exec_build=True):
+            logger.error(f"Build di {packages[0]} fallita")
+            sys.exit(1)
+        return
+
+    if "pytorch" in packages:
+        pytorch_path = base_path / "pytorch"
+        if not build_package(pytorch_path, config):
+            logger.error("Build di pytorch fallita")
+            sys.exit(1)
+
+        wheel = find_wheel(pytorch_path)
+        logger.info(f"Installazione {wheel.name}")
+        subprocess.run([config.python_cmd, "-m", "pip", "install", "--force-reinstall", "--no-deps",
+                        str(wheel)], check=True)
+
+        if config.warmup:
+            warmup_kernel_cache(config.python_cmd)
+
+    dependent = [base_path / package for package in packages if package != "pytorch"]
+    if dependent:
+        failed = build_dependent_packages(dependent, config)
+        if failed:
+            logger.error(f"Build di {', '.join(failed)} fallita")
             sys.exit(1)
 
     logger.info("Build completata con successo")